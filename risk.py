@@ -281,6 +281,54 @@ plotter('Risk word / all words', frac2.results, legend_pos = 'outside right')
 # <codecell>
 riskwords.table
 
+# <markdowncell>
+# Later on, we'll work out a few things from each result, such as summaries and tables. It's handy to remember these, so that asking again is instant. `cached()` stores a value against a result for as long as the result exists. If a result is edited, even in place (say, by renaming it or changing a column), the value is worked out afresh. When a result is thrown away, so is everything stored against it:
+
+# <codecell>
+import weakref
+import zlib
+import numpy as np
+
+_cache = {}
+
+def _fingerprint(result):
+    """shape, names and a checksum of the values, which change when a result is edited in place"""
+    names = tuple(result.columns) if hasattr(result, 'columns') else getattr(result, 'name', None)
+    checksum = zlib.crc32(np.ascontiguousarray(result.values).tobytes())
+    return result.shape, tuple(result.index), names, checksum
+
+def cached(result, name, func):
+    """work out func() once per result, and again whenever the result changes"""
+    key = (id(result), name)
+    stamp = _fingerprint(result)
+    if key in _cache and _cache[key][0]() is result and _cache[key][1] == stamp:
+        return _cache[key][2]
+    value = func()
+    # only hold a weak reference, so the result itself can still be deleted
+    _cache[key] = (weakref.ref(result, lambda ref, key = key: _cache.pop(key, None)), stamp, value)
+    return value
+
+# <markdowncell>
+# For very wide results, like the keywords and n-grams we'll meet later, `.table` can be slow, because every subcorpus gets fully sorted just to find its top few entries. `top_table()` only finds the top `n` in each subcorpus, and then sorts those. Tables are cached, so showing the same one again is instant:
+
+# <codecell>
+import numpy as np
+
+def top_table(df, n = 10):
+    """the n most common entries in each subcorpus"""
+    def make_table():
+        values = df.values
+        names = np.array(df.columns)
+        k = min(n, len(names))
+        # find the top k without sorting everything, then sort just those
+        top = np.argpartition(-values, k - 1, axis = 1)[:, :k]
+        rows = np.arange(len(values))[:, None]
+        top = top[rows, np.argsort(-values[rows, top], axis = 1, kind = 'mergesort')]
+        return pd.DataFrame(names[top].T, index = range(1, k + 1), columns = df.index)
+    return cached(df, ('top_table', n), make_table)
+
+top_table(riskwords.results)
+
 # <markdowncell>
 # ### Customising visualisationsa
 
@@ -353,6 +401,90 @@ fromfile_allwords.totals
 fromfile_allwords = None
 # fromfile_allwords
 
+# <markdowncell>
+# ### Quick, approximate interrogations
+
+# <markdowncell>
+# Interrogating every annual subcorpus can take a long time, which is frustrating when you're still designing a query. One way around this is to interrogate a random sample of files from each year, and scale the counts back up to the size of the full corpus.
+#
+# The function below builds a *stratified* sample: the same proportion of files is drawn from every year, and the sampled files are linked (not copied) into a new corpus directory, named after the sample size and seed. It also returns how much each year needs to be scaled by. Passing a `seed` means you get the same sample every time.
+
+# <codecell>
+import os
+import random
+import numpy as np
+from scipy.stats import chi2
+
+def sample_corpus(corpus, sample = 0.05, seed = None):
+    """make a stratified random sample of a corpus, return its path and scaling factors"""
+    rand = random.Random(seed)
+    sample_path = '%s_sample_%s_seed_%s' % (corpus.rstrip('/'), str(sample).replace('.', ''), seed)
+    factors = {}
+    # for each subcorpus in the corpus
+    for subcorpus in sorted(os.listdir(corpus)):
+        subpath = os.path.join(corpus, subcorpus)
+        if not os.path.isdir(subpath):
+            continue
+        files = sorted([f for f in os.listdir(subpath) if not f.startswith('.')])
+        if not files:
+            continue
+        # always take at least one file, so that no year disappears
+        n = max(1, int(round(len(files) * sample)))
+        chosen = rand.sample(files, n)
+        # make a fresh directory of links to the chosen files
+        outdir = os.path.join(sample_path, subcorpus)
+        if os.path.isdir(outdir):
+            for f in os.listdir(outdir):
+                os.remove(os.path.join(outdir, f))
+        else:
+            os.makedirs(outdir)
+        for f in chosen:
+            os.symlink(os.path.abspath(os.path.join(subpath, f)), os.path.join(outdir, f))
+        factors[subcorpus] = float(len(files)) / n
+    return sample_path, pd.Series(factors)
+
+def estimate(df, factors, alpha = 0.05):
+    """scale sampled counts up to the full corpus, with confidence intervals"""
+    scale = factors.reindex(df.index)
+    est = df.mul(scale, axis = 0)
+    # exact (garwood) poisson intervals: never below zero, and right for small counts
+    k = df.values.astype(float)
+    lower = np.zeros(k.shape)
+    lower[k > 0] = chi2.ppf(alpha / 2, 2 * k[k > 0]) / 2
+    upper = chi2.ppf(1 - alpha / 2, 2 * k + 2) / 2
+    lower = pd.DataFrame(lower, index = df.index, columns = df.columns).mul(scale, axis = 0)
+    upper = pd.DataFrame(upper, index = df.index, columns = df.columns).mul(scale, axis = 0)
+    return est, lower, upper
+
+def plot_estimate(title, est, lower, upper, num_to_plot = 7, y_label = 'Estimated frequency'):
+    """plot estimated counts, with their confidence intervals as bands"""
+    import matplotlib.pyplot as plt
+    if type(est) == pd.core.series.Series:
+        est, lower, upper = est.to_frame(), lower.to_frame(), upper.to_frame()
+    xs = range(len(est.index))
+    fig, ax = plt.subplots(figsize = (13, 6))
+    for entry in list(est.columns)[:num_to_plot]:
+        line, = ax.plot(xs, est[entry], label = entry)
+        ax.fill_between(xs, lower[entry], upper[entry], color = line.get_color(), alpha = 0.2)
+    ax.set_xticks(xs)
+    ax.set_xticklabels(list(est.index), rotation = 45)
+    ax.set_title(title)
+    ax.set_ylabel(y_label)
+    ax.legend(loc = 'best')
+    plt.show()
+
+# <markdowncell>
+# Now we can try out a query on 5% of the corpus, which runs roughly twenty times faster than the full interrogation:
+
+# <codecell>
+sample_trees, factors = sample_corpus(annual_trees, sample = 0.05, seed = 1)
+sampled_riskwords = interrogator(sample_trees, 'words', r'/JJ.?/ < /(?i)\brisk/')
+est, lower, upper = estimate(sampled_riskwords.results, factors)
+plot_estimate('Adjectival risk words (5% sample)', est, lower, upper)
+
+# <markdowncell>
+# If you only want relative frequencies, you don't need to scale anything: `editor(sampled_riskwords.results, '%', sampled_riskwords.totals)` is already an estimate of the proportions in the full corpus. Once the query is doing what you want, run it over `annual_trees` for the final figure.
+
 # <markdowncell>
 # ### `quickview()`
 
@@ -368,6 +500,32 @@ quickview(riskwords, n = 15)
 # <markdowncell>
 # The number shown next to the item is its index. You can use this number to refer to an entry when editing results.
 
+# <markdowncell>
+# `quickview()` works out the totals and ordering from the whole table each time. For big results like `propernouns`, it's worth working these things out once, and then just looking them up. `summarise()` gives each entry its total, rank, first and last subcorpus in which it appears, and the subcorpus in which it peaks. Summaries are cached, so asking again for the same result is free:
+
+# <codecell>
+def summarise(df):
+    """total, rank, first/last non-zero subcorpus and peak subcorpus for each entry"""
+    def make_summary():
+        values = df.values
+        nonzero = values != 0
+        index = np.array(df.index)
+        appears = nonzero.any(axis = 0)
+        summary = pd.DataFrame({'total': values.sum(axis = 0),
+                                'first': np.where(appears, index[nonzero.argmax(axis = 0)], None),
+                                'last': np.where(appears, index[len(index) - 1 - nonzero[::-1].argmax(axis = 0)], None),
+                                'peak': index[values.argmax(axis = 0)]},
+                               index = df.columns, columns = ['total', 'first', 'last', 'peak'])
+        # order entries by total once, so that the top n are just the first n rows
+        summary = summary.iloc[np.argsort(-summary['total'].values, kind = 'mergesort')]
+        summary.insert(0, 'rank', np.arange(1, len(summary) + 1))
+        return summary
+    return cached(df, 'summary', make_summary)
+
+# <codecell>
+summarise(riskwords.results).head(15)
+
+# <markdowncell>
 # ### `editor()`
 
 # <markdowncell>
@@ -516,6 +674,38 @@ u = uniques.T.sum()
 # give our data a name
 u.name = 'Unique risk words'
 
+# <markdowncell>
+# That works, but it makes a whole new copy of the results along the way. If we want a few measures of diversity, we can get them all at once, straight from the counts:
+#
+# * **types**: number of different entries
+# * **tokens**: total number of matches
+# * **hapax**: number of entries occurring only once
+# * **ttr**: type/token ratio
+# * **window ttr**: type/token ratio of a few subcorpora taken together, which is steadier for small years
+
+# <codecell>
+def diversity(df, window = 3):
+    """types, tokens, hapax legomena and type/token ratios for each subcorpus"""
+    values = df.values
+    types = (values > 0).sum(axis = 1)
+    tokens = values.sum(axis = 1)
+    # running totals let us add up each window of subcorpora with one subtraction
+    cumsum = np.vstack([np.zeros((1, values.shape[1])), values.cumsum(axis = 0)])
+    starts = np.maximum(np.arange(len(values)) - window + 1, 0)
+    windowed = cumsum[1:] - cumsum[starts]
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        ttr = np.where(tokens > 0, types / tokens.astype(float), 0)
+        window_ttr = np.where(windowed.sum(axis = 1) > 0,
+                              (windowed > 0).sum(axis = 1) / windowed.sum(axis = 1).astype(float), 0)
+    return pd.DataFrame({'types': types, 'tokens': tokens, 'hapax': (values == 1).sum(axis = 1),
+                         'ttr': ttr, 'window ttr': window_ttr}, index = df.index,
+                        columns = ['types', 'tokens', 'hapax', 'ttr', 'window ttr'])
+
+risk_diversity = diversity(adj_riskwords.results)
+u = risk_diversity['types']
+u.name = 'Unique risk words'
+risk_diversity
+
 # <codecell>
 plotter('Unique risk words', u.drop(['1963', '2014']), y_label = 'Number of unique risk words')
 
@@ -531,7 +721,10 @@ for sty in ['dark_background', 'bmh', 'grayscale', 'fivethirtyeight', 'matplotli
 # So, we can see a generally upward trajectory, with more risk words constantly being used. Many of these results appear once, however, and many are nonwords. *Can you figure out how to remove words that appear only once per year?*
 
 # <codecell>
-#
+# one answer: subtract the hapaxes from the types
+repeated = risk_diversity['types'] - risk_diversity['hapax']
+repeated.name = 'Risk words occurring more than once'
+plotter('Repeated risk words', repeated.drop(['1963', '2014']), y_label = 'Number of risk words occurring more than once')
 
 # <markdowncell>
 # ### conc()
@@ -629,14 +822,70 @@ kwds = interrogator(annual_trees, 'words', 'keywords', dictionary = 'self')
 quickview(kwds.results)
 
 # <codecell>
-kwds.table
+top_table(kwds.results)
 
 # <markdowncell>
-# Let's sort these, based on those increasing/decreasing frequency:
+# Let's sort these, based on those increasing/decreasing frequency.
+#
+# We could use `editor(kwds.results, sort_by = 'increase')`, but that fits a trend line to every keyword, one at a time. For wide results like `kwds`, it's much faster to fit all of the lines at once with a little linear algebra, and to keep the fitted values around so that we can re-sort as often as we like. Passing `robust = True` also calculates Theil&ndash;Sen slopes (the median slope between every pair of years), which are less sensitive to one-off spikes:
 
 # <codecell>
-inc = editor(kwds.results, sort_by = 'increase')
-dec = editor(kwds.results, sort_by = 'decrease')
+import numpy as np
+from scipy.stats import t as t_dist
+
+def trends(df, robust = False, chunksize = 5000):
+    """fit a trend line to every entry at once: slope, intercept, r and p"""
+    # use years as x values if possible, otherwise just count subcorpora
+    try:
+        x = np.array([float(i) for i in df.index])
+    except ValueError:
+        x = np.arange(len(df.index), dtype = float)
+    # count from the first subcorpus, as editor() does, so the intercept is the fitted first value
+    x = x - x[0]
+    y = df.values.astype(float)
+    n = len(x)
+    dx = x - x.mean()
+    dy = y - y.mean(axis = 0)
+    sxx = (dx ** 2).sum()
+    sxy = dx.dot(dy)
+    syy = (dy ** 2).sum(axis = 0)
+    slope = sxy / sxx
+    intercept = y.mean(axis = 0) - slope * x.mean()
+    # entries that never change have no correlation
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        r = np.where(syy > 0, sxy / np.sqrt(sxx * syy), 0.0)
+        tval = r * np.sqrt((n - 2) / np.clip(1 - r ** 2, 1e-12, None))
+    p = 2 * t_dist.sf(np.abs(tval), n - 2)
+    fitted = pd.DataFrame({'slope': slope, 'intercept': intercept, 'r': r, 'p': p},
+                          index = df.columns, columns = ['slope', 'intercept', 'r', 'p'])
+    if robust:
+        # slopes between every pair of years, a chunk of entries at a time
+        i, j = np.triu_indices(n, 1)
+        medians = []
+        for start in range(0, y.shape[1], chunksize):
+            chunk = y[:, start:start + chunksize]
+            pairwise = (chunk[j] - chunk[i]) / (x[j] - x[i])[:, None]
+            medians.append(np.median(pairwise, axis = 0))
+        fitted['theil_sen'] = np.concatenate(medians)
+    return fitted
+
+def sort_by_trend(df, fitted, by = 'slope', decreasing = False, keep_top = False):
+    """reorder entries using trend lines that have already been fitted"""
+    order = np.argsort(fitted[by].values)
+    if not decreasing:
+        order = order[::-1]
+    if keep_top:
+        order = order[:keep_top]
+    return df.iloc[:, order]
+
+# <markdowncell>
+# We only need to fit the lines once. After that, sorting either way (or keeping just the top few entries) is instant:
+
+# <codecell>
+kwd_trends = trends(kwds.results, robust = True)
+inc = sort_by_trend(kwds.results, kwd_trends)
+dec = sort_by_trend(kwds.results, kwd_trends, decreasing = True)
+robust_inc = sort_by_trend(kwds.results, kwd_trends, by = 'theil_sen', keep_top = 50)
 
 # <markdowncell>
 # ... and have a look:
@@ -650,15 +899,100 @@ quickview(dec, 15)
 # <markdowncell>
 # As expected, really. Defunct states and former politicans are on the way out, while newer politicans are on the way in.
 
+# <markdowncell>
+# A single trend line can't tell us *when* something changed, though, and finding sites of change is what we're really after. `changepoints()` tries splitting every entry's time series at each possible year, fits a separate trend line to each side, and keeps the split that fits best. Each side of the break needs at least `min_size` years. All entries are handled at once, and very wide results can be split across processors with `num_proc`. Entries come back ranked by how much of the error of a single line the two lines remove, so big, clear changes come before tiny ones in rare entries. We also get the year of the break, the size of the jump, and `improvement`, the share of the error removed:
+
+# <codecell>
+from multiprocessing import Pool
+
+def _segment_sse(n, sx, sxx, sy, sxy, syy):
+    """residual sum of squares and slope of a least squares line, from sums"""
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        vx = sxx - sx ** 2 / n
+        cov = sxy - sx * sy / n
+        slope = np.where(vx > 0, cov / vx, 0)
+        sse = syy - sy ** 2 / n - np.where(vx > 0, cov ** 2 / vx, 0)
+    return np.maximum(sse, 0), slope
+
+def _best_breaks(args):
+    """find the best single break for every column of a chunk"""
+    x, y, min_size = args
+    n = len(x)
+    # running sums, so any segment's sums are one subtraction
+    zero = np.zeros((1, y.shape[1]))
+    cy = np.vstack([zero, y.cumsum(axis = 0)])
+    cxy = np.vstack([zero, (x[:, None] * y).cumsum(axis = 0)])
+    cyy = np.vstack([zero, (y ** 2).cumsum(axis = 0)])
+    cx = np.concatenate([[0], x.cumsum()])
+    cxx = np.concatenate([[0], (x ** 2).cumsum()])
+    full, _ = _segment_sse(n, cx[n], cxx[n], cy[n], cxy[n], cyy[n])
+    best = np.full(y.shape[1], np.inf)
+    where = np.zeros(y.shape[1], dtype = int)
+    before = np.zeros(y.shape[1])
+    after = np.zeros(y.shape[1])
+    for k in range(min_size, n - min_size + 1):
+        left, left_slope = _segment_sse(k, cx[k], cxx[k], cy[k], cxy[k], cyy[k])
+        right, right_slope = _segment_sse(n - k, cx[n] - cx[k], cxx[n] - cxx[k], cy[n] - cy[k],
+                                          cxy[n] - cxy[k], cyy[n] - cyy[k])
+        better = left + right < best
+        best = np.where(better, left + right, best)
+        where = np.where(better, k, where)
+        before = np.where(better, left_slope, before)
+        after = np.where(better, right_slope, after)
+    cols = np.arange(y.shape[1])
+    mean_before = cy[where, cols] / where
+    mean_after = (cy[n, cols] - cy[where, cols]) / (n - where)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        improvement = np.where(full > 0, 1 - best / full, 0)
+    # how much squared error the break removes, which grows with the size of the change
+    reduction = full - best
+    return where, mean_before, mean_after, before, after, improvement, reduction
+
+def changepoints(df, min_size = 3, num_proc = 1, chunksize = 5000):
+    """find the best break in every entry's trend, ranked by how much error it removes"""
+    try:
+        x = np.array([float(i) for i in df.index])
+    except ValueError:
+        x = np.arange(len(df.index), dtype = float)
+    # each side of a break needs at least min_size subcorpora
+    if len(x) < 2 * min_size:
+        raise ValueError('Need at least %d subcorpora to find a break with min_size = %d, but there are %d' % (
+            2 * min_size, min_size, len(x)))
+    y = df.values.astype(float)
+    chunks = [(x, y[:, i:i + chunksize], min_size) for i in range(0, y.shape[1], chunksize)]
+    if num_proc > 1:
+        pool = Pool(num_proc)
+        try:
+            parts = pool.map(_best_breaks, chunks)
+        finally:
+            # don't leave worker processes behind, even if something went wrong
+            pool.terminate()
+            pool.join()
+    else:
+        parts = [_best_breaks(chunk) for chunk in chunks]
+    where, mean_before, mean_after, before, after, improvement, reduction = [np.concatenate(p) for p in zip(*parts)]
+    breaks = pd.DataFrame({'break': np.array(df.index)[where], 'before': mean_before, 'after': mean_after,
+                           'change': mean_after - mean_before, 'slope before': before,
+                           'slope after': after, 'improvement': improvement, 'reduction': reduction},
+                          index = df.columns, columns = ['break', 'before', 'after', 'change', 'slope before',
+                                                         'slope after', 'improvement', 'reduction'])
+    # rank by the error removed, not the share of it, so tiny changes in rare entries don't come first
+    return breaks.iloc[np.argsort(-breaks['reduction'].values, kind = 'mergesort')]
+
+# <codecell>
+kwd_breaks = changepoints(kwds.results, num_proc = 4)
+kwd_breaks.head(20)
+
 # <markdowncell>
 # So, we can now do some pretty cool stuff in just a few lines of code. Let's concordance the top five keywords, looking at the year in which they are most key:
 
 # <codecell>
 import os
 # iterate through results
-for index, w in enumerate(list(kwds.results)[:5]):
+kwd_summary = summarise(kwds.results)
+for index, w in enumerate(kwd_summary.index[:5]):
     # get the year with most occurrences
-    top_year = kwds.results[w].idxmax()
+    top_year = kwd_summary['peak'][w]
     # print some info
     print '\n%d: %s, %s' % (index + 1, w, str(top_year))
     # get path to that subcorpus
@@ -675,6 +1009,7 @@ for index, w in enumerate(list(kwds.results)[:5]):
 
 # <codecell>
 ngms = interrogator(annual_trees, 'words', 'ngrams')
+top_table(ngms.results)
 
 # <markdowncell>
 # Neat. Now, let's make some thematic categories. This time, we'll make a list of tuples, containing regexes to match, and the result names:
@@ -695,17 +1030,38 @@ regexes = [(r'\b(legislature|medicaid|republican|democrat|federal|council)\b', '
 (r'\b(experiment|council|journal|research|university|researcher|clinical)\b', 'Research')]
 
 # <markdowncell>
-# Now, let's loop through out list and merge keyword and n-gram entries:
+# We could loop through our list, calling `editor()` to merge keyword and n-gram entries for each theme. That means searching every entry once per theme, though, and an entry can only end up in the first theme it matches: *lung* belongs in *The body*, *Infectious disease* and *Non-infectious disease*.
+#
+# Instead, we can classify every entry against all of the themes at once, and then sum each theme with a single matrix multiplication:
 
 # <codecell>
-# NOTE: you can use `print_info = False` if you don't want all this stuff printed.
-for regex, name in regexes:
-    kwds = editor(kwds.results, merge_entries = regex, newname = name)
-    ngms = editor(ngms.results, merge_entries = regex, newname = name, print_info = False)
+import re
+
+def categorise(df, categories):
+    """sum entries into every category whose regex they match, in a single pass"""
+    if hasattr(categories, 'items'):
+        categories = list(categories.items())
+    names = [name for name, regex in categories]
+    # compile the regexes only once
+    compiled = [re.compile(regex) for name, regex in categories]
+    # make a table of which categories each entry belongs to
+    hits = pd.DataFrame([[bool(c.search(entry)) for c in compiled] for entry in df.columns],
+                        index = df.columns, columns = names)
+    # entries x categories: one dot product builds every merged column
+    return df.dot(hits.astype(int)), hits
 
-# now, remove all other entries
-kwds = editor(kwds.results, just_entries = [name for regex, name in regexes])
-ngms = editor(ngms.results, '%', ngms.totals, just_entries = [name for regex, name in regexes])
+themes = [(name, regex) for regex, name in regexes]
+kwds_themes, kwd_hits = categorise(kwds.results, themes)
+ngms_themes, ngm_hits = categorise(ngms.results, themes)
+
+kwds = editor(kwds_themes, print_info = False)
+ngms = editor(ngms_themes, '%', ngms.totals, print_info = False)
+
+# <markdowncell>
+# The second thing returned tells us which themes each entry was counted in. Here are the keywords that fell into more than one:
+
+# <codecell>
+kwd_hits[kwd_hits.sum(axis = 1) > 1]
 
 # <markdowncell>
 # Pretty nifty, eh? Welp, let's plot them:
@@ -754,6 +1110,21 @@ tree = '(ROOT (S (NP (NN Pre-conviction) (NN attachment)) (VP (VBZ carries) (PP
 # currently broken!
 quicktree(tree)
 
+# <markdowncell>
+# Until `quicktree()` is fixed, we can draw trees as text with NLTK:
+
+# <codecell>
+from StringIO import StringIO
+from nltk import Tree
+
+def drawtree(tree):
+    """print a bracketed parse tree as a text diagram"""
+    diagram = StringIO()
+    Tree.fromstring(tree).pretty_print(stream = diagram)
+    print diagram.getvalue()
+
+drawtree(tree)
+
 # <markdowncell>
 # `searchtree()` requires a tree and a Tregex query. It will return a list of query matches.
 
@@ -761,6 +1132,161 @@ quicktree(tree)
 print searchtree(tree, r'/VB.?/ >># (VP $ NP)')
 print searchtree(tree, r'NP')
 
+# <markdowncell>
+# To practise a query on real data, without running `conc()` or `interrogator()`, we can run Tregex over a whole subcorpus and read its matches as they arrive. `search_subcorpus()` starts Tregex just once, and doesn't read any further than you ask it to, so you can stop after the first few matches. Each match comes with its file and the number of its tree (counting from the start of the subcorpus):
+
+# <codecell>
+import os
+import subprocess
+from itertools import islice
+
+def search_subcorpus(path, query):
+    """lazily search every tree in a file or subcorpus, yielding (file, tree number, match)"""
+    # -f prints each file name, -n numbers each match's tree, -s puts each match on one line
+    devnull = open(os.devnull, 'w')
+    tregex = subprocess.Popen(['tregex.sh', '-f', '-n', '-s', query, path],
+                              stdout = subprocess.PIPE, stderr = devnull)
+    filename = None
+    try:
+        for line in iter(tregex.stdout.readline, ''):
+            line = line.strip()
+            if line.startswith('# '):
+                filename = os.path.basename(line[2:])
+            elif line:
+                number, match = line.split(':', 1)
+                yield filename, int(number), match.strip()
+    finally:
+        # stop Tregex if we stopped reading early
+        if tregex.poll() is None:
+            tregex.kill()
+        tregex.stdout.close()
+        tregex.wait()
+        devnull.close()
+
+for filename, number, match in islice(search_subcorpus('data/nyt/years/1989', r'/VB.?/ >># (VP $ NP)'), 10):
+    print '%s, tree %d: %s' % (filename, number, match)
+
+# <markdowncell>
+# Before running a very long query over the whole corpus, it's nice to know how long it will take, and which parts of it will do the most work. `explain()` uses a sample you've already made with `sample_corpus()` (`sample_trees`, from earlier), so it doesn't write anything to disk. It times the query over the sample, and scales the time up to the size of the whole corpus. Starting Tregex takes the same time however small a subcorpus is, so that part is timed separately and isn't scaled. It also checks how many of the sampled trees contain each node description in the query. The rarer a description, the better an anchor it is: a query can only match trees that contain every description it needs. Descriptions after `!` or `?`, or in one branch of a `|`, don't have to be there at all, so they are shown but never used as the anchor.
+
+# <codecell>
+import re
+import time
+import tempfile
+
+# tregex node descriptions (with any |alternatives), node names, relations and everything else
+_tregex_token = re.compile(r'''(?P<node>(?:/(?:\\/|[^/])+/|@?[A-Za-z][\w\-]*\$?|__)(?:\|(?:/(?:\\/|[^/])+/|@?[A-Za-z][\w\-]*\$?))*)
+                               |(?P<name>[=~]\w+)
+                               |(?P<relation>[<>$.,:][<>$.,:#\-+]*\d*(?:(?<=\+)\([^()]*\))?)
+                               |(?P<other>[!?|()\[\]])''', re.X)
+
+def _node_descriptions(query):
+    """the node descriptions in a tregex query, and whether every match needs each one"""
+    found = []
+    stack = [{'nodes': [], 'alt': False, 'blocked': False, 'head': None, 'relation': False}]
+    negate = pending = False
+    def close(frame):
+        # in a group with '|' in it, only the group's own head node is needed
+        if frame['alt']:
+            for node in frame['nodes']:
+                if node is not frame['head']:
+                    node[1] = False
+    for match in _tregex_token.finditer(query):
+        kind, token = match.lastgroup, match.group()
+        top = stack[-1]
+        if kind == 'node':
+            if token != '__':
+                # nodes under '!' or '?' don't have to be there at all
+                node = [token, not (top['blocked'] or pending or negate)]
+                if not top['nodes'] and not top['relation']:
+                    top['head'] = node
+                top['nodes'].append(node)
+                found.append(node)
+            pending = negate = False
+        elif kind == 'relation':
+            top['relation'] = True
+            pending, negate = negate, False
+        elif token in '!?':
+            negate = True
+        elif token == '|':
+            top['alt'] = True
+        elif token in '([':
+            stack.append({'nodes': [], 'alt': False, 'blocked': top['blocked'] or pending,
+                          'head': None, 'relation': False})
+            pending = False
+        elif token in ')]' and len(stack) > 1:
+            frame = stack.pop()
+            close(frame)
+            stack[-1]['nodes'].extend(frame['nodes'])
+    for frame in reversed(stack):
+        close(frame)
+    descriptions = []
+    for token, needed in found:
+        if token not in [d for d, n in descriptions]:
+            descriptions.append((token, any(n for t, n in found if t == token)))
+    return descriptions
+
+def _node_test(description):
+    """a function telling us if a node label or word fits a node description"""
+    tests = []
+    for alternative in re.findall(r'/(?:\\/|[^/])+/|[^|]+', description):
+        if alternative.startswith('/'):
+            tests.append(re.compile(alternative[1:-1]).search)
+        elif alternative.startswith('@'):
+            tests.append(lambda node, label = alternative[1:]: node.split('-')[0] == label)
+        else:
+            tests.append(lambda node, label = alternative: node == label)
+    return lambda node: any(test(node) for test in tests)
+
+def explain(query, sample_path, factors):
+    """estimate the cost of a Tregex query from a sample made with sample_corpus()"""
+    descriptions, required = [], {}
+    for description, needed in _node_descriptions(query):
+        try:
+            descriptions.append((description, _node_test(description)))
+            required[description] = needed
+        except re.error:
+            print 'Skipping %s: not a Python regex' % description
+    # count sampled trees containing each description, and estimate the corpus size
+    hits = dict((name, 0.0) for name, test in descriptions)
+    sampled, estimated = 0, 0.0
+    for subcorpus in sorted(factors.index):
+        for filename, number, tree in search_subcorpus(os.path.join(sample_path, subcorpus), 'ROOT'):
+            nodes = set(re.findall(r'\((\S+)', tree)) | set(re.findall(r'([^\s()]+)\)', tree))
+            sampled += 1
+            estimated += factors[subcorpus]
+            for name, test in descriptions:
+                if any(test(node) for node in nodes):
+                    hits[name] += factors[subcorpus]
+    # time starting Tregex on nothing: this happens once per subcorpus, whatever its size
+    devnull = open(os.devnull, 'w')
+    with tempfile.NamedTemporaryFile() as empty:
+        start = time.time()
+        subprocess.call(['tregex.sh', 'ROOT', empty.name], stdout = devnull, stderr = devnull)
+        fixed = (time.time() - start) * len(factors)
+    devnull.close()
+    # time the real thing on the sample, and only scale up the time spent on trees
+    start = time.time()
+    interrogator(sample_path, 'count', query)
+    taken = time.time() - start
+    per_tree = max(taken - fixed, 0) / max(sampled, 1)
+    predicted = fixed + per_tree * estimated
+    report = pd.DataFrame({'trees': pd.Series(hits), 'required': pd.Series(required)}, columns = ['trees', 'required'])
+    report = report.iloc[np.argsort(report['trees'].values, kind = 'mergesort')]
+    report['share'] = report['trees'] * 100.0 / estimated
+    # only descriptions that every match needs can rule trees out
+    needed = report[report['required'] == True]
+    print 'Trees in corpus (estimated): %d' % estimated
+    print 'Candidate trees (estimated): %d' % (needed['trees'].min() if len(needed) else estimated)
+    if len(needed):
+        print 'Most selective anchor: %s' % needed.index[0]
+    print 'Predicted runtime: %.1f minutes (%.1f seconds on %d sampled trees, %.1f of them starting Tregex)' % (
+        predicted / 60, taken, sampled, fixed)
+    return report
+
+# <codecell>
+explain(r'/VB.?/ >># (VP $ NP)', sample_trees, factors)
+
 # <markdowncell>
 # Now you're familiar with the corpus and functions. In the sections below, we'll perform a formal, followed by a functional, analysis of risk. Let's start with the formal side of things:
 
@@ -1217,32 +1743,51 @@ print rel_risker.results
 # Aside from giving it an integer value, you can pass it `'low'`, `'medium'` or `'high'`.  `editor()` then creates thresholds based on the total total of `noun_lemmata.totals`. Passing no threshold results in '`medium` being used as the default (total words in second list / 5000):
 
 # <codecell>
-# total / 10,000
-print editor(subj_of_risk_process.results, '%', noun_lemmata.results, 
-    just_totals = True, threshold = 'low', sort_by = 'total').results
-# total / 5,000
-print editor(subj_of_risk_process.results, '%', noun_lemmata.results, 
-    just_totals = True, threshold = 'medium', sort_by = 'total').results
 # total / 2,500
-rel_risker = editor(subj_of_risk_process.results, '%', noun_lemmata.results, 
+print editor(subj_of_risk_process.results, '%', noun_lemmata.results, 
     just_totals = True, threshold = 'high', sort_by = 'total').results
 
+# <markdowncell>
+# `noun_lemmata` contains every noun lemma in the corpus, so a call like this has to line up two very wide tables before it can do any maths, and comparing the three thresholds would mean doing it three times. Instead, we can line the two vocabularies up once, throw away entries below the lowest threshold *before* dividing, and then pick out each threshold from the same answer:
+
+# <codecell>
+import numpy as np
+
+def relative_totals(df, df2, thresholds = ['low', 'medium', 'high']):
+    """entry totals in df as a percentage of entry totals in df2, for several thresholds at once"""
+    totals = df.sum()
+    # look up each entry of df in df2 by name
+    other = df2.sum().reindex(totals.index).fillna(0).values
+    # thresholds are based on the grand total of the second list, as in editor()
+    grand = float(df2.values.sum())
+    levels = {'low': grand / 10000, 'medium': grand / 5000, 'high': grand / 2500}
+    limits = [levels.get(t, t) for t in thresholds]
+    # mask before dividing, so we only divide where at least one threshold is met
+    keep = other >= max(min(limits), 1)
+    ratios = pd.Series(totals.values[keep] * 100.0 / other[keep], index = totals.index[keep])
+    kept = other[keep]
+    # sort once; each threshold is then just a mask over the same ordering
+    order = np.argsort(-ratios.values, kind = 'mergesort')
+    ratios, kept = ratios.iloc[order], kept[order]
+    return dict((t, ratios[kept >= limit]) for t, limit in zip(thresholds, limits))
+
+risker_by_threshold = relative_totals(subj_of_risk_process.results, noun_lemmata.results)
+rel_risker = risker_by_threshold['high']
+
 # <markdowncell>
 # OK, let's see what we have:
 
 # <codecell>
-plotter('Riskers', rel_risker.results, num_to_plot = 12, kind = 'bar', colours = 'Dark2')
+plotter('Riskers', rel_risker, num_to_plot = 12, kind = 'bar', colours = 'Dark2')
 
 # <markdowncell>
 # We could also invert the order to find out who rarely risks. Notice how in below, the things least likely to risk are also quite likely to be risked things or negative outcomes.
 
 # <codecell>
-non_risked = editor(subj_of_risk_process.results, '%', noun_lemmata.results, 
-    just_totals = True, threshold = 'low', sort_by = 'least', print_info = False)
-plotter('Seldom riskers', non_risked.results, 
+non_risked = risker_by_threshold['low'][::-1]
+plotter('Seldom riskers', non_risked, 
         num_to_plot = 12, kind = 'bar', colours = 'Dark2', fontsize = 16)
 
-
 # <markdowncell>
 # ... and, one more exercise, just for fun. The `'self'` option for `editor()` calculates the modified results as percentage of their own total. Let's use this, and plot the proportion of a few different kinds of human risker:
 
@@ -1411,7 +1956,7 @@ plotter('Most common proper noun phrases, increasing', editor(propernouns.result
 plotter('Most common proper noun phrases, decreasing', editor(propernouns.results, '%', propernouns.totals, sort_by = 'decrease', skip_subcorpora=[1963]).results)
 
 # <codecell>
-quickview(propernouns, n = 200)
+summarise(propernouns.results).head(200)
 
 # <markdowncell>
 # Notice that there are a few entries here that refer to the same group. (*f.d.a.* and *food and drug administration*, for example). We can use `editor()` to fix these.
@@ -1427,9 +1972,29 @@ to_merge = [("f.d.a .", "food and drug administration"),
     ("i.m.f .", "international monetary fund")]
 
 safe_copy = propernouns.results.copy() # just in case
-for short, long in to_merge:
-    propernouns = editor(propernouns.results, merge_entries = [short, long], newname = short)
-propernouns = editor(propernouns.results, sort_by = 'total')
+
+# <markdowncell>
+# We could call `editor()` once for each pair, but that rebuilds the whole table every time. Instead, we can turn the list into an alias map, and merge everything in one go. Regular expressions can be added as extra rules for spelling variants that are hard to list:
+
+# <codecell>
+import re
+
+def resolve_aliases(df, aliases, regex_rules = []):
+    """rename entries with an alias map and regex rules, then merge them in one pass"""
+    # compile the rules only once
+    compiled = [(re.compile(pattern), name) for pattern, name in regex_rules]
+    def canonical(entry):
+        if entry in aliases:
+            return aliases[entry]
+        for pattern, name in compiled:
+            if pattern.search(entry):
+                return name
+        return entry
+    # sum each group of aliases into a single column
+    return df.T.groupby(canonical, sort = False).sum().T
+
+aliases = dict((lon, short) for short, lon in to_merge)
+propernouns = editor(resolve_aliases(propernouns.results, aliases), sort_by = 'total', print_info = False)
 propernouns.results
 
 # <markdowncell>
@@ -1462,12 +2027,12 @@ for name, query, data in theme_list:
     plotter(name, data.results, y_label = ystring, legend_pos = 'upper left')
 
 # <markdowncell>
-# Let's compare these topics in the same chart, using Pandas to join everything together:
+# Let's compare these topics in the same chart, using `categorise()` to count every theme at once:
 
 # <codecell>
-import pandas
-# get the totals from each theme and put them together
-them_comp = pandas.concat([data.totals for name, query, data in theme_list], axis=1)
+# get the totals for every theme in a single pass
+rel_propernouns = editor(propernouns.results, '%', propernouns.totals, print_info = False)
+them_comp, theme_hits = categorise(rel_propernouns.results, [(name, query) for name, query, data in theme_list])
 them_comp = editor(them_comp, sort_by = 'total')
 quickview(them_comp)
 
@@ -1492,6 +2057,13 @@ plotter('Merck and Vioxx', vioxx.results)
 # <markdowncell>
 # Vioxx was removed from shelves following the discovery that it increased the risk of heart attack. It's interesting how even though terrorism and war may come to mind when thinking of *risk* in the past 15 years, this health topic is easily more prominent in the data.
 
+# <markdowncell>
+# Rather than spotting these by eye, we can ask `changepoints()` which proper nouns change most sharply, and when:
+
+# <codecell>
+changepoints(editor(propernouns.results, '%', propernouns.totals, skip_subcorpora = [1963], print_info = False).results, 
+             num_proc = 4).head(20)
+
 # <markdowncell>
 # ## Discussion
 
@@ -1677,18 +2249,48 @@ plotter('Risk by modifier type', mods.results, y_label = 'Percentage of risk wor
 # risk_distance_from_root = load_result('risk_distance_from_root')
 risk_distance_from_root = interrogator('data/nyt/years', 'a', r'(?i)\brisk')
 
+# <markdowncell>
+# We want to compare three periods. Merging subcorpora with `editor()` adds up each period row by row. If we keep a running total down the years instead, the total for any run of years is just one row of the running total minus another, however long the period is. We can also name our periods once, and reuse them for any result:
+
 # <codecell>
-d = {'1963': r'1963',
-     '1987--1990': r'(198.|1990)',
-     '2011--2014': r'201.'}
+periods = {}
+
+def running_totals(df):
+    """cumulative sums down the subcorpus axis, with a row of zeros on top"""
+    def make_totals():
+        cumsum = np.vstack([np.zeros((1, len(df.columns))), df.values.cumsum(axis = 0)])
+        positions = dict((str(name), i) for i, name in enumerate(df.index))
+        return cumsum, positions
+    return cached(df, 'running_totals', make_totals)
+
+def span_total(df, start, end):
+    """totals for each entry over a span of subcorpora, inclusive"""
+    cumsum, positions = running_totals(df)
+    for year in [start, end]:
+        if str(year) not in positions:
+            raise ValueError('No subcorpus called %s' % str(year))
+    return pd.Series(cumsum[positions[str(end)] + 1] - cumsum[positions[str(start)]], index = df.columns)
+
+def register_period(name, start, end):
+    """name a span of subcorpora, so that it can be reused"""
+    periods[name] = (start, end)
+
+def merge_periods(df, names):
+    """make a new result with one row per named period"""
+    merged = pd.concat([span_total(df, *periods[name]) for name in names], axis = 1).T
+    merged.index = names
+    return merged
 
 d = {'1963': ['1963'],
      '1987--1990': ['1987', '1988', '1989', '1990'],
      '2011--2014': ['2011', '2012', '2013', '2014']}
 
-     
-e = editor(risk_distance_from_root.results, '%', 'self', merge_subcorpora = d, 
-           keep_top = 10, just_subcorpora = d.keys())
+for name, years in d.items():
+    register_period(name, years[0], years[-1])
+
+# <codecell>
+three_periods = merge_periods(risk_distance_from_root.results, sorted(d))
+e = editor(three_periods, '%', 'self', keep_top = 10)
 f = editor(risk_distance_from_root.results, '%', 'self', keep_top = 10)
 
 # <codecell>